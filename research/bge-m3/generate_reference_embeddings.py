@@ -1,82 +1,167 @@
-import json
-import onnxruntime as ort
+import argparse
 import numpy as np
-from onnxruntime_extensions import get_library_path
 import os
+import sys
 
-def convert_tokenizer_outputs(tokens, token_indices):
-    """Convert tokenizer outputs to model input format"""
-    # Pair tokens with their indices and sort by position
-    token_pairs = list(zip(token_indices, tokens))
-    token_pairs.sort()  # Sort by position (token_indices)
+# The ONNX Runtime helpers shared by the research scripts live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from onnx_sessions import (
+    OnnxEmbedder,
+    ensure_quantized,
+    get_accelerated_providers,
+    get_model_variant_path,
+    is_derived_model_current,
+    truncate_embeddings,
+    write_json_records
+)
+
+# Special token IDs excluded from the sparse weights
+SPECIAL_TOKEN_IDS = (0, 1, 2, 3)
+
+# Size of the XLM-RoBERTa vocabulary used by BGE-M3
+VOCAB_SIZE = 250002
+
+def build_special_token_mask(special_token_ids=SPECIAL_TOKEN_IDS):
+    """Build a boolean lookup table over the vocabulary that is True for special tokens"""
+    is_special = np.zeros(VOCAB_SIZE, dtype=bool)
+    is_special[list(special_token_ids)] = True
+    return is_special
+
+def ensure_postprocessed(model_path):
+    """Create a copy of the model that also outputs the lexical weights of every vocabulary token, unless an up to date one exists"""
+    postprocessed_model_path = get_model_variant_path(model_path, "_postprocessed")
+    # The copy references the weights by file offsets, so it is rebuilt whenever the model or its weights change
+    if is_derived_model_current(postprocessed_model_path, model_path):
+        return postprocessed_model_path
     
-    # Get ordered tokens
-    ordered_tokens = [pair[1] for pair in token_pairs]
+    # Only needed to edit the model graph
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
     
-    # Create input_ids and attention_mask
-    input_ids = np.array([ordered_tokens], dtype=np.int64)
-    attention_mask = np.ones_like(input_ids, dtype=np.int64)
+    # Only the graph is rewritten, the copy keeps referencing the original external weights
+    print(f"Adding post-processing to model: {postprocessed_model_path}")
+    model = onnx.load(model_path, load_external_data=False)
+    graph = model.graph
+    
+    graph.initializer.extend([
+        numpy_helper.from_array(build_special_token_mask(), "postprocess_is_special"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "postprocess_squeeze_axes"),
+        numpy_helper.from_array(np.array([VOCAB_SIZE], dtype=np.int64), "postprocess_vocab_size"),
+        numpy_helper.from_array(np.array(1, dtype=np.int64), "postprocess_one"),
+        numpy_helper.from_array(np.array(0, dtype=np.float32), "postprocess_zero")
+    ])
+    graph.node.extend([
+        # Zero the weights of padding and special tokens
+        helper.make_node("Squeeze", ["sparse_weights", "postprocess_squeeze_axes"], ["postprocess_token_weights"]),
+        helper.make_node("Gather", ["postprocess_is_special", "input_ids"], ["postprocess_special_mask"]),
+        helper.make_node("Not", ["postprocess_special_mask"], ["postprocess_regular_mask"]),
+        helper.make_node("Equal", ["attention_mask", "postprocess_one"], ["postprocess_attended_mask"]),
+        helper.make_node("And", ["postprocess_attended_mask", "postprocess_regular_mask"], ["postprocess_keep_mask"]),
+        helper.make_node("Where", ["postprocess_keep_mask", "postprocess_token_weights", "postprocess_zero"], ["postprocess_kept_weights"]),
+        
+        # Scatter into a [batch, vocab_size] tensor, keeping the maximum weight of each token id
+        helper.make_node("Shape", ["input_ids"], ["postprocess_batch_size"], end=1),
+        helper.make_node("Concat", ["postprocess_batch_size", "postprocess_vocab_size"], ["postprocess_output_shape"], axis=0),
+        helper.make_node(
+            "ConstantOfShape",
+            ["postprocess_output_shape"],
+            ["postprocess_zeros"],
+            value=helper.make_tensor("value", TensorProto.FLOAT, [1], [0.0])
+        ),
+        helper.make_node(
+            "ScatterElements",
+            ["postprocess_zeros", "input_ids", "postprocess_kept_weights"],
+            ["lexical_weights"],
+            axis=1,
+            reduction="max"
+        )
+    ])
+    graph.output.append(helper.make_tensor_value_info("lexical_weights", TensorProto.FLOAT, ["batch_size", VOCAB_SIZE]))
     
-    return input_ids, attention_mask
+    onnx.save_model(model, postprocessed_model_path)
+    
+    return postprocessed_model_path
 
-class OnnxBGEM3Embedder:
+class OnnxBGEM3Embedder(OnnxEmbedder):
     """BGE-M3 embedder using ONNX tokenizer and model"""
     
-    def __init__(self, tokenizer_path, model_path):
+    def __init__(self, tokenizer_path, model_path, providers=None, intra_op_num_threads=None, output_dim=None,
+                 cache_optimized_model=False, special_token_ids=SPECIAL_TOKEN_IDS):
         """Initialize the embedder with ONNX tokenizer and model"""
-        # Initialize tokenizer session
-        sess_options = ort.SessionOptions()
-        sess_options.register_custom_ops_library(get_library_path())
-        self.tokenizer_session = ort.InferenceSession(
-            tokenizer_path,
-            sess_options=sess_options,
-            providers=['CPUExecutionProvider']
-        )
-        
-        # Initialize model session
-        self.model_session = ort.InferenceSession(
-            model_path,
-            providers=['CPUExecutionProvider']
-        )
+        super().__init__(tokenizer_path, model_path, providers, intra_op_num_threads, output_dim, cache_optimized_model)
         
         # Special token IDs for sparse weights filtering
-        self.special_token_ids = {0, 1, 2, 3}
+        self.special_token_ids = special_token_ids
+    
+    @property
+    def special_token_ids(self):
+        """Token IDs excluded from the sparse weights, post-processed models use the SPECIAL_TOKEN_IDS built into their graph"""
+        return self._special_token_ids
+    
+    @special_token_ids.setter
+    def special_token_ids(self, special_token_ids):
+        # Filtering looks tokens up in a table over the vocabulary, rebuilt whenever the IDs change
+        self._special_token_ids = frozenset(special_token_ids)
+        self._is_special = build_special_token_mask(self._special_token_ids)
     
     def encode(self, text):
         """Generate all three types of embeddings for the input text"""
-        # Tokenize the input
-        tokenizer_outputs = self.tokenizer_session.run(None, {"inputs": np.array([text])})
-        tokens, _, token_indices = tokenizer_outputs
-        
-        # Convert to model input format
-        input_ids, attention_mask = convert_tokenizer_outputs(tokens, token_indices)
-        
-        # Generate embeddings
-        model_outputs = self.model_session.run(None, {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask
-        })
-        
+        return self._encode_text(text)
+    
+    def _copy_result(self, result):
+        """Copy a result so callers can modify it without affecting the cached one"""
+        return {
+            "dense_vecs": result["dense_vecs"].copy(),
+            "lexical_weights": dict(result["lexical_weights"]),
+            "colbert_vecs": result["colbert_vecs"].copy()
+        }
+    
+    def _convert_outputs(self, input_ids, attention_mask, outputs):
+        """Convert the model outputs of a batch to one result per row"""
         # ONNX outputs: dense_embeddings, sparse_weights, colbert_vectors
-        dense_embeddings, sparse_weights, colbert_vectors = model_outputs
+        # and lexical_weights when the model includes post-processing
+        lexical_weights = outputs.get("lexical_weights")
+        dense_embeddings = outputs["dense_embeddings"]
+        if self.output_dim is not None:
+            dense_embeddings = truncate_embeddings(dense_embeddings, self.output_dim)
         
+        return [
+            self._process_outputs(
+                input_ids[row],
+                attention_mask[row],
+                dense_embeddings[row],
+                outputs["sparse_weights"][row],
+                outputs["colbert_vectors"][row],
+                lexical_weights[row] if lexical_weights is not None else None
+            )
+            for row in range(input_ids.shape[0])
+        ]
+    
+    def _process_outputs(self, input_ids, attention_mask, dense_embeddings, sparse_weights, colbert_vectors, lexical_weights=None):
+        """Convert the model outputs of a single batch row to the reference format"""
         # Process dense embeddings
-        dense_vecs = dense_embeddings[0].tolist()  # Convert to list for JSON serialization
+        dense_vecs = dense_embeddings  # Serialized as a numpy array by orjson
         
-        # Process sparse weights
-        sparse_dict = {}
-        for i, token_id in enumerate(input_ids[0]):
-            if attention_mask[0, i] == 1 and token_id not in self.special_token_ids:
-                weight = sparse_weights[0, i]  # [batch, seq_len]
-                if weight > 0:
-                    token_id_int = int(token_id)
-                    sparse_dict[str(token_id_int)] = max(sparse_dict.get(str(token_id_int), 0), float(weight.item()))
+        if lexical_weights is not None:
+            # Sparse weights were already reduced per vocabulary token by the model
+            token_ids = np.flatnonzero(lexical_weights)
+            sparse_dict = dict(zip(token_ids.astype(str).tolist(), lexical_weights[token_ids].tolist()))
+        else:
+            # Process sparse weights: keep the maximum weight of each non-special token
+            weights = sparse_weights.reshape(-1)  # [seq_len, 1] -> [seq_len]
+            keep = (attention_mask == 1) & ~self._is_special[input_ids] & (weights > 0)
+            token_ids, weights = input_ids[keep], weights[keep]
+            
+            # Group weights by token id and reduce each group to its maximum
+            order = np.argsort(token_ids, kind='stable')
+            token_ids, weights = token_ids[order], weights[order]
+            unique_ids, starts = np.unique(token_ids, return_index=True)
+            max_weights = np.maximum.reduceat(weights, starts)
+            sparse_dict = dict(zip(unique_ids.astype(str).tolist(), max_weights.tolist()))
         
-        # Process ColBERT vectors
-        colbert_list = []
-        for i in range(colbert_vectors.shape[1]):  # Iterate over sequence length
-            if attention_mask[0, i] == 1:  # Only include non-padding tokens
-                colbert_list.append(colbert_vectors[0, i].tolist())  # Convert to list for JSON
+        # Process ColBERT vectors: only include non-padding tokens
+        mask = attention_mask[1:].astype(bool)  # ColBERT vectors skip the leading [CLS] token
+        colbert_list = colbert_vectors[mask]  # Serialized as a numpy array by orjson
         
         return {
             "dense_vecs": dense_vecs,
@@ -87,12 +172,46 @@ class OnnxBGEM3Embedder:
 def main():
     """Generate reference embeddings for all three types using BGE-M3 ONNX models"""
     
+    parser = argparse.ArgumentParser(description="Generate BGE-M3 reference embeddings")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use an int8 quantized copy of the model (faster, but not bit-compatible with the fp32 model used by the .NET tests)"
+    )
+    parser.add_argument(
+        "--postprocess-in-model",
+        action="store_true",
+        help="compute the lexical weights inside the ONNX graph using a post-processed copy of the model"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="encode all texts in one padded model run (faster, but padding changes float reductions so results can differ slightly from the unpadded runs of the .NET tests)"
+    )
+    parser.add_argument(
+        "--accelerate",
+        action="store_true",
+        help="run on the available accelerated execution providers (OpenVINO, DirectML, CoreML) ahead of the CPU, results may differ from the CPU reference"
+    )
+    parser.add_argument(
+        "--cache-optimized-model",
+        action="store_true",
+        help="save the optimized model graph next to the model and load it on later runs (writes a full extra copy of the weights)"
+    )
+    args = parser.parse_args()
+    
     script_dir = os.getcwd()
     onnx_dir = os.path.join(script_dir, "onnx")
     
     tokenizer_path = os.path.join(onnx_dir, "bge_m3_tokenizer.onnx")
     model_path = os.path.join(onnx_dir, "bge_m3_model.onnx")
-    output_path = os.path.join(onnx_dir, "bge_m3_reference_embeddings.json")
+    # Results that may deviate from the CPU fp32 reference are written to a separate file
+    output_suffix = (
+        ("_int8" if args.quantize else "")
+        + ("_batched" if args.batch else "")
+        + ("_accelerated" if args.accelerate else "")
+    )
+    output_path = os.path.join(onnx_dir, f"bge_m3_reference_embeddings{output_suffix}.json")
     
     print(f"Using tokenizer: {tokenizer_path}")
     print(f"Using model: {model_path}")
@@ -106,10 +225,24 @@ def main():
     if not os.path.exists(model_path):
         print(f"ERROR: Model file not found at {model_path}")
         return
+    
+    if args.quantize:
+        model_path = ensure_quantized(model_path)
+        print(f"Using quantized model: {model_path}")
+    
+    if args.postprocess_in_model:
+        model_path = ensure_postprocessed(model_path)
+        print(f"Using post-processed model: {model_path}")
 
     # Initialize the BGE-M3 embedder
     print("Initializing BGE-M3 ONNX embedder...")
-    embedder = OnnxBGEM3Embedder(tokenizer_path, model_path)
+    providers = get_accelerated_providers() if args.accelerate else None
+    embedder = OnnxBGEM3Embedder(
+        tokenizer_path,
+        model_path,
+        providers=providers,
+        cache_optimized_model=args.cache_optimized_model
+    )
     
     # Test texts
     test_texts = [
@@ -123,19 +256,18 @@ def main():
         "English, Español, Русский, 中文, العربية, हिन्दी"
     ]
     
-    embeddings = {}
-    
-    for text in test_texts:
-        result = embedder.encode(text)
-        
-        embeddings[text] = result
+    if args.batch:
+        # Encode all texts in a single batched model run
+        results = embedder.encode_batch(test_texts)
+    else:
+        # Encode each text alone and unpadded like the .NET tests, one at a time while writing
+        results = map(embedder.encode, test_texts)
     
-    # Save to JSON file
+    # Save to JSON file, streaming one embedding at a time
     print(f"\nSaving reference embeddings to {output_path}")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(embeddings, f, ensure_ascii=False, indent=2)
+    count = write_json_records(output_path, zip(test_texts, results))
     
-    print(f"Saved {len(embeddings)} reference embeddings with all three types (dense, sparse, ColBERT)")
+    print(f"Saved {count} reference embeddings with all three types (dense, sparse, ColBERT)")
     print("\nReference embeddings generated successfully!")
 
 if __name__ == "__main__":
@@ -1,85 +1,109 @@
-import json
-import onnxruntime as ort
-import numpy as np
-from onnxruntime_extensions import get_library_path
+import argparse
 import os
+import sys
+from functools import lru_cache
 
-def convert_tokenizer_outputs(tokens, token_indices):
-    """Convert tokenizer outputs to model input format"""
-    # Pair tokens with their indices and sort by position
-    token_pairs = list(zip(token_indices, tokens))
-    token_pairs.sort()  # Sort by position (token_indices)
-    
-    # Get ordered tokens
-    ordered_tokens = [pair[1] for pair in token_pairs]
-    
-    # Create input_ids and attention_mask
-    input_ids = np.array([ordered_tokens], dtype=np.int64)
-    attention_mask = np.ones_like(input_ids, dtype=np.int64)
-    
-    return input_ids, attention_mask
+# The ONNX Runtime helpers shared by the research scripts live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from onnx_sessions import (
+    OnnxEmbedder,
+    ensure_quantized,
+    get_accelerated_providers,
+    truncate_embeddings,
+    write_json_records
+)
 
-class OnnxE5LargeInstructEmbedder:
+class OnnxE5LargeInstructEmbedder(OnnxEmbedder):
     """E5 Large Instruct embedder using ONNX tokenizer and model"""
     
-    def __init__(self, tokenizer_path, model_path):
+    def __init__(self, tokenizer_path, model_path, providers=None, intra_op_num_threads=None, output_dim=None,
+                 cache_optimized_model=False):
         """Initialize the embedder with ONNX tokenizer and model"""
-        # Initialize tokenizer session
-        sess_options = ort.SessionOptions()
-        sess_options.register_custom_ops_library(get_library_path())
-        self.tokenizer_session = ort.InferenceSession(
-            tokenizer_path,
-            sess_options=sess_options,
-            providers=['CPUExecutionProvider']
-        )
+        super().__init__(tokenizer_path, model_path, providers, intra_op_num_threads, output_dim, cache_optimized_model)
         
-        # Initialize model session
-        self.model_session = ort.InferenceSession(
-            model_path,
-            providers=['CPUExecutionProvider']
-        )
+        # Memoize tokenizer outputs, instructed queries are often encoded repeatedly
+        self.tokenize = lru_cache(maxsize=1024)(self._tokenize)
+    
+    @staticmethod
+    def make_prefix(task_description: str) -> str:
+        """Build the instruction prefix shared by all queries of a task"""
+        return f'Instruct: {task_description}\nQuery: '
     
     @staticmethod
     def get_detailed_instruct(task_description: str, query: str) -> str:
         """Format query with instruction as required by E5"""
-        return f'Instruct: {task_description}\nQuery: {query}'
+        return OnnxE5LargeInstructEmbedder.make_prefix(task_description) + query
+    
+    def _tokenize(self, text):
+        """Tokenize a single text into model inputs"""
+        input_ids, attention_mask = super().tokenize(text)
+        
+        # Cached outputs are shared between calls and must not be modified
+        input_ids.setflags(write=False)
+        
+        return input_ids, attention_mask
     
     def encode(self, texts):
         """Generate embeddings for the input texts"""
         if isinstance(texts, str):
             texts = [texts]
         
-        embeddings = []
+        embeddings = [self._encode_text(text) for text in texts]
         
-        for text in texts:
-            # Tokenize the input
-            tokenizer_outputs = self.tokenizer_session.run(None, {"inputs": np.array([text])})
-            tokens, _, token_indices = tokenizer_outputs
-            
-            # Convert to model input format
-            input_ids, attention_mask = convert_tokenizer_outputs(tokens, token_indices)
-            
-            # Generate embeddings
-            model_outputs = self.model_session.run(None, {
-                "input_ids": input_ids,
-                "attention_mask": attention_mask
-            })
-            
-            # Extract normalized embeddings
-            embedding = model_outputs[0][0]  # Remove batch dimension
-            embeddings.append(embedding.tolist())  # Convert to list for JSON serialization
+        return embeddings if len(embeddings) != 1 else embeddings[0]
+    
+    def _convert_outputs(self, input_ids, attention_mask, outputs):
+        """Convert the model outputs of a batch to one result per row"""
+        # Extract normalized embeddings, one row per text
+        embeddings = outputs[self._output_names[0]]
+        if self.output_dim is not None:
+            embeddings = truncate_embeddings(embeddings, self.output_dim)
         
-        return embeddings if len(embeddings) > 1 else embeddings[0]
+        return list(embeddings)  # Serialized as numpy arrays by orjson
+    
+    def encode_queries(self, task_description, queries):
+        """Generate embeddings for queries instructed with the same task in a single model run"""
+        prefix = self.make_prefix(task_description)
+        return self.encode_batch([prefix + query for query in queries])
 
 def main():
     """Generate reference embeddings using E5 Large Instruct ONNX models"""
     
+    parser = argparse.ArgumentParser(description="Generate E5 Large Instruct reference embeddings")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use an int8 quantized copy of the model (faster, but not bit-compatible with the fp32 model used by the .NET tests)"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="encode all texts in one padded model run (faster, but padding changes float reductions so results can differ slightly from the unpadded runs of the .NET tests)"
+    )
+    parser.add_argument(
+        "--accelerate",
+        action="store_true",
+        help="run on the available accelerated execution providers (OpenVINO, DirectML, CoreML) ahead of the CPU, results may differ from the CPU reference"
+    )
+    parser.add_argument(
+        "--cache-optimized-model",
+        action="store_true",
+        help="save the optimized model graph next to the model and load it on later runs (writes a full extra copy of the weights)"
+    )
+    args = parser.parse_args()
+    
     script_dir = os.getcwd()
     onnx_dir = os.path.join(script_dir, "onnx")
     
     tokenizer_path = os.path.join(onnx_dir, "e5_large_instruct_tokenizer.onnx")
     model_path = os.path.join(onnx_dir, "e5_large_instruct_model.onnx")
-    output_path = os.path.join(onnx_dir, "e5_large_instruct_reference_embeddings.json")
+    # Results that may deviate from the CPU fp32 reference are written to a separate file
+    output_suffix = (
+        ("_int8" if args.quantize else "")
+        + ("_batched" if args.batch else "")
+        + ("_accelerated" if args.accelerate else "")
+    )
+    output_path = os.path.join(onnx_dir, f"e5_large_instruct_reference_embeddings{output_suffix}.json")
     
     print(f"Using tokenizer: {tokenizer_path}")
     print(f"Using model: {model_path}")
@@ -93,10 +117,20 @@ def main():
     if not os.path.exists(model_path):
         print(f"ERROR: Model file not found at {model_path}")
         return
+    
+    if args.quantize:
+        model_path = ensure_quantized(model_path)
+        print(f"Using quantized model: {model_path}")
 
     # Initialize the E5 Large Instruct embedder
     print("Initializing E5 Large Instruct ONNX embedder...")
-    embedder = OnnxE5LargeInstructEmbedder(tokenizer_path, model_path)
+    providers = get_accelerated_providers() if args.accelerate else None
+    embedder = OnnxE5LargeInstructEmbedder(
+        tokenizer_path,
+        model_path,
+        providers=providers,
+        cache_optimized_model=args.cache_optimized_model
+    )
     
     # Test data matching the original example
     task = 'Given a web search query, retrieve relevant passages that answer the query'
@@ -122,27 +156,26 @@ def main():
         "summarization_query": embedder.get_detailed_instruct("Summarize the following passage", "The quick brown fox jumps over the lazy dog. This sentence contains every letter of the alphabet."),
     }
     
-    embeddings = {}
-    
     print(f"\nGenerating embeddings for {len(test_cases)} test cases...")
-    for name, text in test_cases.items():
-        print(f"Processing: {name}")
-        embedding = embedder.encode(text)
-        embeddings[name] = {
-            "text": text,
-            "embedding": embedding
-        }
-    
-    # Save to JSON file
+    if args.batch:
+        # Encode all test cases in a single batched model run
+        results = embedder.encode_batch(list(test_cases.values()))
+    else:
+        # Encode each test case alone and unpadded like the .NET tests
+        results = [embedder.encode(text) for text in test_cases.values()]
+    
+    # Save to JSON file, streaming one embedding at a time
     print(f"\nSaving reference embeddings to {output_path}")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(embeddings, f, ensure_ascii=False, indent=2)
+    count = write_json_records(output_path, (
+        (name, {"text": text, "embedding": embedding})
+        for (name, text), embedding in zip(test_cases.items(), results)
+    ))
     
     # Print some statistics
-    first_embedding = list(embeddings.values())[0]["embedding"]
-    print(f"\nSaved {len(embeddings)} reference embeddings")
+    first_embedding = results[0]
+    print(f"\nSaved {count} reference embeddings")
     print(f"Embedding dimension: {len(first_embedding)}")
-    print(f"Sample embedding (first 5 values): {first_embedding[:5]}")
+    print(f"Sample embedding (first 5 values): {first_embedding[:5].tolist()}")
     print("\nReference embeddings generated successfully!")
 
 if __name__ == "__main__":
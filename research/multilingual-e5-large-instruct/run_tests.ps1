@@ -48,7 +48,7 @@ try {
 }
 
 # Check if required packages are installed
-$packages = @("onnxruntime", "onnxruntime_extensions", "numpy")
+$packages = @("onnxruntime", "onnxruntime_extensions", "numpy", "orjson")
 $missingPackages = @()
 
 foreach ($pkg in $packages) {
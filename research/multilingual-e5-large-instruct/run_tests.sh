@@ -38,7 +38,7 @@ fi
 echo "Found Python: $(python3 --version)"
 
 # Check if required packages are installed
-PACKAGES=("onnxruntime" "onnxruntime-extensions" "numpy")
+PACKAGES=("onnxruntime" "onnxruntime-extensions" "numpy" "orjson")
 MISSING_PACKAGES=()
 
 for pkg in "${PACKAGES[@]}"; do
@@ -0,0 +1,378 @@
+import onnxruntime as ort
+import orjson
+import numpy as np
+from onnxruntime_extensions import get_library_path
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+@lru_cache(maxsize=1024)
+def get_attention_mask(length):
+    """Get a read-only all-ones attention mask, shared between calls with the same length"""
+    attention_mask = np.ones((1, length), dtype=np.int64)
+    attention_mask.setflags(write=False)
+    return attention_mask
+
+def convert_tokenizer_outputs(tokens, token_indices):
+    """Convert tokenizer outputs to model input format"""
+    tokens = np.asarray(tokens)
+    token_indices = np.asarray(token_indices)
+    
+    # Order tokens by position (token_indices)
+    order = np.argsort(token_indices, kind='stable')
+    
+    # Create input_ids and attention_mask
+    input_ids = tokens[order][None, :].astype(np.int64, copy=False)
+    attention_mask = get_attention_mask(tokens.size)
+    
+    return input_ids, attention_mask
+
+# Providers used unless accelerators are requested, the .NET tests compare against CPU results
+DEFAULT_PROVIDERS = ('CPUExecutionProvider',)
+
+# Accelerated execution providers in order of preference, ORT falls back to the next one for unsupported ops
+PREFERRED_PROVIDERS = [
+    'OpenVINOExecutionProvider',
+    'DmlExecutionProvider',
+    'CoreMLExecutionProvider',
+    'CPUExecutionProvider'
+]
+
+PROVIDER_OPTIONS = {
+    'OpenVINOExecutionProvider': {'device_type': 'CPU', 'precision': 'FP32'},
+    'DmlExecutionProvider': {'device_id': 0}
+}
+
+def get_accelerated_providers():
+    """Select the preferred execution providers available in the installed ONNX Runtime"""
+    available_providers = ort.get_available_providers()
+    return tuple(provider for provider in PREFERRED_PROVIDERS if provider in available_providers)
+
+_ort_env_configured = False
+
+def ensure_ort_env():
+    """Configure the process-wide ONNX Runtime environment once, before the first session is created"""
+    global _ort_env_configured
+    if not _ort_env_configured:
+        # Only report errors, exported models trigger harmless graph cleanup warnings
+        ort.set_default_logger_severity(3)
+        _ort_env_configured = True
+
+@lru_cache(maxsize=1)
+def get_tokenizer_executor():
+    """Get the thread pool shared by all embedders for tokenizing texts, created once"""
+    # ORT releases the GIL while running a session, so texts are tokenized concurrently
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+@lru_cache(maxsize=8)
+def get_tokenizer_session(tokenizer_path):
+    """Get a tokenizer session with the ONNX Runtime Extensions custom ops, created once per path"""
+    sess_options = ort.SessionOptions()
+    sess_options.register_custom_ops_library(get_library_path())
+    return ort.InferenceSession(
+        tokenizer_path,
+        sess_options=sess_options,
+        providers=['CPUExecutionProvider']
+    )
+
+def get_model_variant_path(model_path, suffix):
+    """Get the path of a model variant stored next to the model, with a suffix added to the file name"""
+    model_dir, model_file = os.path.split(model_path)
+    model_name, model_ext = os.path.splitext(model_file)
+    return os.path.join(model_dir, model_name + suffix + model_ext)
+
+def get_model_file_paths(model_path):
+    """List the model graph file and the external weights files its initializers reference"""
+    # Only needed to read the external data locations, the onnx package is also required to create model variants
+    import onnx
+    
+    model = onnx.load(model_path, load_external_data=False)
+    locations = {
+        entry.value
+        for tensor in model.graph.initializer
+        if tensor.data_location == onnx.TensorProto.EXTERNAL
+        for entry in tensor.external_data
+        if entry.key == "location"
+    }
+    
+    model_dir = os.path.dirname(model_path)
+    return [model_path] + [os.path.join(model_dir, location) for location in sorted(locations)]
+
+def is_derived_model_current(derived_model_path, model_path):
+    """Check that a file derived from a model is newer than the model graph and the weights files it references"""
+    if not os.path.exists(derived_model_path):
+        return False
+    
+    source_mtime = max(os.path.getmtime(path) for path in get_model_file_paths(model_path) if os.path.exists(path))
+    return os.path.getmtime(derived_model_path) > source_mtime
+
+def remove_model_files(model_path):
+    """Delete a model graph and its external weights files, onnx appends to weights files that already exist"""
+    if os.path.exists(model_path):
+        for path in get_model_file_paths(model_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def save_optimized_model(model_path, optimized_model_path):
+    """Save the model graph after the hardware independent optimizations, with its weights stored externally"""
+    sess_options = ort.SessionOptions()
+    # Saved graphs must not contain hardware specific optimizations, ORT recommends the extended level
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_options.optimized_model_filepath = optimized_model_path
+    # Store the weights of the optimized graph externally, models exceed the 2GB protobuf limit
+    sess_options.add_session_config_entry(
+        "session.optimized_model_external_initializers_file_name",
+        os.path.basename(optimized_model_path) + "_data"
+    )
+    
+    print(f"Saving optimized model to: {optimized_model_path}")
+    ort.InferenceSession(model_path, sess_options=sess_options, providers=['CPUExecutionProvider'])
+
+@lru_cache(maxsize=8)
+def get_model_session(model_path, providers=None, intra_op_num_threads=None, cache_optimized_model=False):
+    """Get an inference session with graph optimizations and tuned threading, created once per configuration"""
+    provider_names = list(providers) if providers is not None else list(DEFAULT_PROVIDERS)
+    providers = [
+        (provider, PROVIDER_OPTIONS[provider]) if provider in PROVIDER_OPTIONS else provider
+        for provider in provider_names
+    ]
+    
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.enable_cpu_mem_arena = True
+    sess_options.inter_op_num_threads = 1
+    # Default to one thread per physical core, assuming two hardware threads per core
+    sess_options.intra_op_num_threads = intra_op_num_threads or max(1, (os.cpu_count() or 2) // 2)
+    
+    if 'DmlExecutionProvider' in provider_names:
+        # DirectML does not support memory pattern optimization
+        sess_options.enable_mem_pattern = False
+    
+    # The saved optimized graph is specific to the execution providers, only cache it for CPU.
+    # Every run loads the saved graph, including the one that creates it, so all runs use the
+    # same graph; the hardware specific optimizations are still applied when loading it
+    if cache_optimized_model and provider_names == ['CPUExecutionProvider']:
+        optimized_model_path = model_path + ".opt"
+        if not is_derived_model_current(optimized_model_path, model_path):
+            save_optimized_model(model_path, optimized_model_path)
+        model_path = optimized_model_path
+    
+    return ort.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+
+def ensure_quantized(model_path):
+    """Create an int8 dynamically quantized copy of the model unless an up to date one exists"""
+    quantized_model_path = get_model_variant_path(model_path, "_int8")
+    if is_derived_model_current(quantized_model_path, model_path):
+        return quantized_model_path
+    
+    # Only needed for quantization, which also requires the onnx package
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    # Quantize again from scratch when the model changed since the copy was created
+    remove_model_files(quantized_model_path)
+    print(f"Quantizing model to: {quantized_model_path}")
+    quantize_dynamic(
+        model_input=model_path,
+        model_output=quantized_model_path,
+        op_types_to_quantize=['MatMul', 'Gemm'],
+        weight_type=QuantType.QInt8,
+        use_external_data_format=True
+    )
+    
+    return quantized_model_path
+
+# Padded sequence lengths, batches of the same bucket reuse input buffers and tensor shapes
+# (the 1024 bucket is only reached by models accepting more than 512 tokens, such as BGE-M3)
+SEQUENCE_LENGTH_BUCKETS = (32, 64, 128, 256, 512, 1024)
+
+def get_bucket_length(length):
+    """Round a sequence length up to its bucket, longer sequences are not padded further"""
+    return next((bucket for bucket in SEQUENCE_LENGTH_BUCKETS if bucket >= length), length)
+
+def pad_model_inputs(tokenized, pad_token_id, buffers=None):
+    """Right-pad per-text model inputs into a single batch of bucketed length"""
+    batch_size = len(tokenized)
+    length = get_bucket_length(max(input_ids.shape[1] for input_ids, _ in tokenized))
+    
+    # Reuse the buffers of the bucket, growing them when the batch has more rows than before.
+    # Lengths beyond the largest bucket are not buffered, they would add one entry per length
+    buffered = buffers.get(length) if buffers is not None else None
+    if buffered is None or buffered[0].shape[0] < batch_size:
+        input_ids = np.empty((batch_size, length), dtype=np.int64)
+        attention_mask = np.empty_like(input_ids)
+        if buffers is not None and length in SEQUENCE_LENGTH_BUCKETS:
+            buffers[length] = (input_ids, attention_mask)
+    else:
+        input_ids, attention_mask = buffered
+    # Leading rows of a larger buffer are contiguous and can be bound to the model directly
+    input_ids, attention_mask = input_ids[:batch_size], attention_mask[:batch_size]
+    
+    # Padding positions are excluded through the attention mask
+    input_ids.fill(pad_token_id)
+    attention_mask.fill(0)
+    for row, (text_input_ids, text_attention_mask) in enumerate(tokenized):
+        input_ids[row, :text_input_ids.shape[1]] = text_input_ids[0]
+        attention_mask[row, :text_attention_mask.shape[1]] = text_attention_mask[0]
+    
+    return input_ids, attention_mask
+
+def truncate_embeddings(embeddings, output_dim):
+    """Keep the first output_dim dimensions of the embeddings and L2-normalize them again"""
+    truncated = embeddings[..., :output_dim]
+    return truncated / np.linalg.norm(truncated, axis=-1, keepdims=True)
+
+def write_json_records(output_path, records):
+    """Write (key, value) records to a JSON object file one at a time, without indentation"""
+    count = 0
+    # orjson produces UTF-8 bytes, write them as-is
+    with open(output_path, 'wb') as f:
+        f.write(b"{\n")
+        for key, value in records:
+            if count > 0:
+                f.write(b",\n")
+            f.write(orjson.dumps(key))
+            f.write(b": ")
+            f.write(orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY))
+            count += 1
+        f.write(b"\n}\n")
+    
+    return count
+
+class OnnxEmbedder:
+    """Base class for embedders running an ONNX tokenizer and model, subclasses convert the model outputs"""
+    
+    def __init__(self, tokenizer_path, model_path, providers=None, intra_op_num_threads=None, output_dim=None,
+                 cache_optimized_model=False):
+        """Initialize the embedder with ONNX tokenizer and model"""
+        ensure_ort_env()
+        
+        # Initialize tokenizer session
+        self.tokenizer_session = get_tokenizer_session(tokenizer_path)
+        
+        # Initialize model session
+        self.model_session = get_model_session(
+            model_path,
+            tuple(providers) if providers is not None else None,  # Hashable for the session cache
+            intra_op_num_threads,
+            cache_optimized_model
+        )
+        
+        # Reusable binding of model inputs and outputs
+        self._io_binding = self.model_session.io_binding()
+        self._output_names = [output.name for output in self.model_session.get_outputs()]
+        
+        # XLM-RoBERTa <pad> token used to right-pad batched inputs
+        self.pad_token_id = 1
+        # Padded model inputs by bucket length, refilled for every batch
+        self._input_buffers = {}
+        
+        # Optional number of leading dense dimensions to keep, faster similarity search at lower quality
+        if output_dim is not None:
+            embedding_dim = self.model_session.get_outputs()[0].shape[-1]
+            # Only the lower bound can be checked when the model declares a symbolic dimension
+            if output_dim <= 0 or (isinstance(embedding_dim, int) and output_dim > embedding_dim):
+                raise ValueError(f"output_dim must be between 1 and the embedding dimension {embedding_dim}, got {output_dim}")
+        self.output_dim = output_dim
+        
+        # Result for empty texts, computed by the first unpadded run of one
+        self._empty_result = None
+        
+        self._warmup()
+    
+    def _warmup(self):
+        """Run a dummy batch so lazy weight packing and buffer allocation happen at startup"""
+        # Uses the smallest bucket shape, larger buckets are primed by their first real batch
+        input_ids = np.zeros((1, SEQUENCE_LENGTH_BUCKETS[0]), dtype=np.int64)
+        attention_mask = np.ones_like(input_ids)
+        try:
+            self.model_session.run(None, {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask
+            })
+        except Exception as e:
+            print(f"WARNING: Model warm-up failed: {e}")
+    
+    def close(self):
+        """Release the session references held by this embedder"""
+        # Sessions are cached and may be shared, clear get_model_session's cache to free them entirely
+        self._io_binding = None
+        self.model_session = None
+        self.tokenizer_session = None
+    
+    def tokenize(self, text):
+        """Tokenize a single text into model inputs"""
+        # The tokenizer custom op only accepts one string per run
+        tokenizer_outputs = self.tokenizer_session.run(None, {"inputs": np.array([text])})
+        tokens, _, token_indices = tokenizer_outputs
+        
+        return convert_tokenizer_outputs(tokens, token_indices)
+    
+    def _encode_text(self, text):
+        """Run the model on a single text without padding, the way the .NET tests run it"""
+        if not text:
+            return self._get_empty_result()
+        
+        return self._run_unpadded(text)
+    
+    def encode_batch(self, texts):
+        """Generate embeddings for the input texts in a single padded model run"""
+        if not texts:
+            return []
+        if all(texts):
+            return self._encode_batch(texts)
+        
+        non_empty_texts = [text for text in texts if text]
+        results = iter(self._encode_batch(non_empty_texts) if non_empty_texts else [])
+        return [next(results) if text else self._get_empty_result() for text in texts]
+    
+    def _get_empty_result(self):
+        """Get the result for an empty text, computed by one unpadded run and copied for each caller"""
+        # Empty texts always tokenize to the same input, so the result of encoding "" by itself is reused
+        if self._empty_result is None:
+            self._empty_result = self._run_unpadded("")
+        
+        return self._copy_result(self._empty_result)
+    
+    def _run_unpadded(self, text):
+        """Run the model on the tokenized text alone, as a batch of one row without padding"""
+        input_ids, attention_mask = self.tokenize(text)
+        
+        return self._convert_outputs(input_ids, attention_mask, self._run_model(input_ids, attention_mask))[0]
+    
+    def _encode_batch(self, texts):
+        """Run the model once for a batch of texts"""
+        # Tokenize each text and pad into one batch, padding changes the order of float
+        # reductions so results can differ slightly from unpadded runs of the same texts
+        input_ids, attention_mask = pad_model_inputs(
+            list(get_tokenizer_executor().map(self.tokenize, texts)),
+            self.pad_token_id,
+            self._input_buffers
+        )
+        
+        return self._convert_outputs(input_ids, attention_mask, self._run_model(input_ids, attention_mask))
+    
+    def _run_model(self, input_ids, attention_mask):
+        """Run the model on a batch of inputs and return its outputs by name"""
+        # Inputs are bound without copying into a feed dict
+        self._io_binding.bind_cpu_input("input_ids", input_ids)
+        self._io_binding.bind_cpu_input("attention_mask", attention_mask)
+        # Outputs are rebound unallocated, their shape depends on the batch
+        for output_name in self._output_names:
+            self._io_binding.bind_output(output_name, "cpu")
+        self.model_session.run_with_iobinding(self._io_binding)
+        outputs = dict(zip(self._output_names, self._io_binding.copy_outputs_to_cpu()))
+        
+        # Release the ORT-allocated outputs, such as the full ColBERT tensor of BGE-M3, and the
+        # input arrays, the binding would otherwise keep them alive until the next run
+        self._io_binding.clear_binding_outputs()
+        self._io_binding.clear_binding_inputs()
+        
+        return outputs
+    
+    def _convert_outputs(self, input_ids, attention_mask, outputs):
+        """Convert the model outputs of a batch to one result per row"""
+        raise NotImplementedError
+    
+    def _copy_result(self, result):
+        """Copy a result so callers can modify it without affecting the cached one"""
+        return result.copy()